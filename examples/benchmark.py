@@ -2,20 +2,91 @@ from __future__ import print_function
 import openmm.app as app
 import openmm as mm
 import openmm.unit as unit
-from datetime import datetime
+import time
 import os
+import math
+import copy
+import sys
+import io
+import contextlib
+import numpy as np
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import pickle
+import functools
+import hashlib
+
+# The tests that can be run.  Each one is described by a dict with the following entries:
+#
+# forceField: the force field files to create the System from
+# pdb: the PDB file containing the structure to simulate
+# amber: the name of the prmtop and inpcrd files in the Amber benchmark suite, used instead of forceField and pdb
+# method: the nonbonded method
+# cutoff: the nonbonded cutoff.  If omitted, the cutoff from the command line is used.
+# explicit: whether the system is solvated in explicit water [default: True]
+# amoeba: whether the system uses the AMOEBA force field [default: False]
+# extraArgs: additional arguments to pass to createSystem()
+
+apoa1ForceField = ('amber14/protein.ff14SB.xml', 'amber14/lipid17.xml', 'amber14/tip3p.xml')
+TESTS = {
+    'gbsa': dict(forceField=('amber99sb.xml', 'amber99_obc.xml'), pdb='5dfr_minimized.pdb', method=app.CutoffNonPeriodic, cutoff=2*unit.nanometers, explicit=False),
+    'rf': dict(forceField=('amber99sb.xml', 'tip3p.xml'), pdb='5dfr_solv-cube_equil.pdb', method=app.CutoffPeriodic, cutoff=1*unit.nanometers),
+    'pme': dict(forceField=('amber99sb.xml', 'tip3p.xml'), pdb='5dfr_solv-cube_equil.pdb', method=app.PME),
+    'apoa1rf': dict(forceField=apoa1ForceField, pdb='apoa1.pdb', method=app.CutoffPeriodic, cutoff=1*unit.nanometers),
+    'apoa1pme': dict(forceField=apoa1ForceField, pdb='apoa1.pdb', method=app.PME),
+    'apoa1ljpme': dict(forceField=apoa1ForceField, pdb='apoa1.pdb', method=app.LJPME),
+    'amoebagk': dict(forceField=('amoeba2009.xml', 'amoeba2009_gk.xml'), pdb='5dfr_minimized.pdb', method=app.NoCutoff, explicit=False, amoeba=True),
+    'amoebapme': dict(forceField=('amoeba2009.xml',), pdb='5dfr_solv-cube_equil.pdb', method=app.PME, cutoff=0.7*unit.nanometers, amoeba=True,
+                      extraArgs=dict(vdwCutoff=0.9*unit.nanometers, ewaldErrorTolerance=0.00075)),
+    'amber20-dhfr': dict(amber='JAC', method=app.PME),
+    'amber20-factorix': dict(amber='FactorIX', method=app.PME),
+    'amber20-cellulose': dict(amber='Cellulose', method=app.PME),
+    'amber20-stmv': dict(amber='STMV', method=app.PME)
+}
+
+@functools.lru_cache(maxsize=None)
+def loadForceField(files):
+    """Load a ForceField, reusing the one created by an earlier test if possible."""
+    return app.ForceField(*files)
+
+@functools.lru_cache(maxsize=None)
+def loadPdb(file):
+    """Load a PDB file, reusing the one loaded by an earlier test if possible."""
+    return app.PDBFile(file)
 
 def timeIntegration(context, steps, initialSteps):
     """Integrate a Context for a specified number of steps, then return how many seconds it took."""
     context.getIntegrator().step(initialSteps) # Make sure everything is fully initialized
-    context.getState(getEnergy=True)
-    start = datetime.now()
+    context.getState(getPositions=True)
+    start = time.perf_counter_ns()
     context.getIntegrator().step(steps)
-    context.getState(getEnergy=True)
-    end = datetime.now()
-    elapsed = end-start
-    return elapsed.seconds + elapsed.microseconds*1e-6
+    context.getState(getPositions=True) # Wait for the steps to finish without computing energy
+    end = time.perf_counter_ns()
+    energy = context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+    if not math.isfinite(energy):
+        raise ValueError('Energy is not finite: the simulation is unstable')
+    return (end-start)*1e-9
+
+def calibrate(context, initialSteps, budget=2.0):
+    """Integrate a Context for approximately the specified number of seconds, then return how many seconds each step took."""
+    integrator = context.getIntegrator()
+    integrator.step(initialSteps) # Make sure everything is fully initialized
+    context.getState(getPositions=True)
+    steps = 0
+    blockSize = 10
+    start = time.perf_counter_ns()
+    while True:
+        integrator.step(blockSize)
+        steps += blockSize
+        context.getState(getPositions=True)
+        seconds = (time.perf_counter_ns()-start)*1e-9
+        if seconds >= budget:
+            return seconds/steps
+
+        # Choose the next block size from the speed measured so far, so each block takes about a tenth of the budget
+        # whether the system is fast or slow.
+
+        blockSize = max(1, int(0.1*budget*steps/seconds))
 
 def downloadAmberSuite():
     """Download and extract Amber benchmark to Amber20_Benchmark_Suite/ in current directory."""
@@ -23,21 +94,165 @@ def downloadAmberSuite():
     url = 'https://ambermd.org/Amber20_Benchmark_Suite.tar.gz'
     if not os.path.exists(dirname):
         import urllib.request
-        print('Downloading', url)
-        filename, headers = urllib.request.urlretrieve(url, filename='Amber20_Benchmark_Suite.tar.gz')
         import tarfile
-        print('Extracting', filename)
-        tarfh = tarfile.open(filename, 'r:gz')
-        tarfh.extractall(path=dirname)
+        import shutil
+        import subprocess
+        import threading
+        print('Downloading and extracting', url)
+        partial = dirname+'.partial'
+        with urllib.request.urlopen(url) as response:
+            # Extract the archive while it is being downloaded.  If pigz is available, use it to decompress the data in a
+            # separate process, so decompression overlaps with downloading and extraction instead of running in Python.
+            if shutil.which('pigz') is not None:
+                pigz = subprocess.Popen(['pigz', '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                feedErrors = []
+                stopped = threading.Event()
+                def feed():
+                    try:
+                        shutil.copyfileobj(response, pigz.stdin)
+                    except Exception as ex:
+                        if not stopped.is_set():
+                            feedErrors.append(ex)
+                    finally:
+                        try:
+                            pigz.stdin.close()
+                        except OSError:
+                            pass
+                feeder = threading.Thread(target=feed)
+                feeder.start()
+                try:
+                    with tarfile.open(fileobj=pigz.stdout, mode='r|') as tarfh:
+                        tarfh.extractall(path=partial)
+                    pigz.stdout.read() # Discard any padding after the end of the archive
+                except BaseException:
+                    # Stop pigz so the feeder thread can't block forever writing to it.  If the download failed,
+                    # report that rather than the truncated archive it produced.
+                    stopped.set()
+                    pigz.kill()
+                    pigz.stdout.close()
+                    feeder.join()
+                    pigz.wait()
+                    if len(feedErrors) > 0:
+                        raise feedErrors[0]
+                    raise
+                pigz.stdout.close()
+                feeder.join()
+                if len(feedErrors) > 0:
+                    raise feedErrors[0]
+                if pigz.wait() != 0:
+                    raise RuntimeError('pigz failed to decompress %s' % url)
+            else:
+                with tarfile.open(fileobj=response, mode='r|gz') as tarfh:
+                    tarfh.extractall(path=partial)
+        os.rename(partial, dirname)
     return dirname
 
-def runOneTest(testName, options):
+def loadAmberFiles(testName, options):
+    """Parse the prmtop and inpcrd files for one of the Amber benchmarks, loading them from the cache if a previous
+    run already parsed them."""
+    prmtopFile, inpcrdFile = inputFiles(testName)
+    if not options.systemCache:
+        return app.AmberPrmtopFile(prmtopFile), app.AmberInpcrdFile(inpcrdFile)
+
+    # The pickle holds the internal state of the Python classes, so it is only valid for the build that wrote it.
+
+    cacheFile = os.path.join(options.systemCache, '%s-%s.pkl' % (TESTS[testName]['amber'], cacheKey([prmtopFile, inpcrdFile])))
+    if os.path.exists(cacheFile):
+        with open(cacheFile, 'rb') as f:
+            return pickle.load(f)
+    prmtop = app.AmberPrmtopFile(prmtopFile)
+    inpcrd = app.AmberInpcrdFile(inpcrdFile)
+    os.makedirs(options.systemCache, exist_ok=True)
+    with open(cacheFile+'.partial', 'wb') as f:
+        pickle.dump((prmtop, inpcrd), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(cacheFile+'.partial', cacheFile)
+    return prmtop, inpcrd
+
+def createSystem(testName, options):
+    """Create the System for a test, and return it along with the initial positions and periodic box vectors."""
+    spec = TESTS[testName]
+    args = dict(nonbondedMethod=spec['method'])
+    if spec['method'] != app.NoCutoff:
+        args['nonbondedCutoff'] = spec.get('cutoff', options.cutoff)
+    if 'amber' in spec:
+        prmtop, inpcrd = loadAmberFiles(testName, options)
+        system = prmtop.createSystem(constraints=app.HBonds, **args)
+        return system, inpcrd.positions, inpcrd.boxVectors
+    ff = loadForceField(spec['forceField'])
+    pdb = loadPdb(spec['pdb'])
+    if spec.get('amoeba', False):
+        args.update(constraints=None, mutualInducedTargetEpsilon=float(options.epsilon), polarization=options.polarization)
+    elif options.heavy:
+        args.update(constraints=app.AllBonds, hydrogenMass=4*unit.amu)
+    else:
+        args.update(constraints=app.HBonds, hydrogenMass=1.5*unit.amu)
+    args.update(spec.get('extraArgs', {}))
+    system = ff.createSystem(pdb.topology, **args)
+    if spec.get('amoeba', False):
+        for f in system.getForces():
+            if isinstance(f, mm.AmoebaMultipoleForce) or isinstance(f, mm.AmoebaVdwForce) or isinstance(f, mm.AmoebaGeneralizedKirkwoodForce) or isinstance(f, mm.AmoebaWcaDispersionForce):
+                f.setForceGroup(1)
+    return system, pdb.positions, None
+
+def inputFiles(testName):
+    """Return the paths of the files a test's System is created from."""
+    spec = TESTS[testName]
+    if 'amber' in spec:
+        dirname = downloadAmberSuite()
+        fileName = spec['amber']
+        return [os.path.join(dirname, f'PME/Topologies/{fileName}.prmtop'), os.path.join(dirname, f'PME/Coordinates/{fileName}.inpcrd')]
+    dataDir = os.path.join(os.path.dirname(app.__file__), 'data')
+    return [f if os.path.isfile(f) else os.path.join(dataDir, f) for f in spec['forceField']+(spec['pdb'],)]
+
+def cacheKey(files, *values):
+    """Return a string that identifies the OpenMM build, the modification times and sizes of a set of files, and
+    any other values, so that cached data is not reused once any of them has changed."""
+    h = hashlib.sha1(mm.version.git_revision.encode())
+    for f in files:
+        info = os.stat(f)
+        h.update(('%s:%d:%d' % (os.path.abspath(f), info.st_mtime_ns, info.st_size)).encode())
+    for value in values:
+        h.update(repr(value).encode())
+    return h.hexdigest()[:16]
+
+def buildOrLoadSystem(testName, options):
+    """Return the System, positions, and box vectors for a test, loading them from the cache if a previous
+    run already created them, and otherwise creating them and adding them to the cache."""
+    if not options.systemCache:
+        return createSystem(testName, options)
+    key = '%s-%s' % (testName, cacheKey(inputFiles(testName), TESTS[testName], options.cutoff, options.epsilon, options.polarization, options.heavy))
+    systemFile = os.path.join(options.systemCache, key+'.xml')
+    positionsFile = os.path.join(options.systemCache, key+'.npz')
+    if os.path.exists(systemFile) and os.path.exists(positionsFile):
+        with open(systemFile) as f:
+            system = mm.XmlSerializer.deserialize(f.read())
+        with np.load(positionsFile) as data:
+            positions = data['positions']*unit.nanometers
+            boxVectors = ([mm.Vec3(*v)*unit.nanometers for v in data['boxVectors']] if 'boxVectors' in data else None)
+        return system, positions, boxVectors
+    system, positions, boxVectors = createSystem(testName, options)
+    os.makedirs(options.systemCache, exist_ok=True)
+
+    # Write each file under a temporary name and then rename it, so an interrupted run can't leave a truncated
+    # file in the cache.
+
+    with open(systemFile+'.partial', 'w') as f:
+        f.write(mm.XmlSerializer.serialize(system))
+    os.replace(systemFile+'.partial', systemFile)
+    arrays = {'positions': np.array(positions.value_in_unit(unit.nanometers))}
+    if boxVectors is not None:
+        arrays['boxVectors'] = np.array([v.value_in_unit(unit.nanometers) for v in boxVectors])
+    with open(positionsFile+'.partial', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(positionsFile+'.partial', positionsFile)
+    return system, positions, boxVectors
+
+def runOneTest(testName, options, platform):
     """Perform a single benchmarking simulation."""
-    explicit = (testName not in ('gbsa', 'amoebagk'))
-    amoeba = (testName in ('amoebagk', 'amoebapme'))
-    apoa1 = testName.startswith('apoa1')
-    amber = (testName.startswith('amber'))
-    hydrogenMass = None
+    spec = TESTS[testName]
+    explicit = spec.get('explicit', True)
+    amoeba = spec.get('amoeba', False)
+    amber = ('amber' in spec)
     print()
     if amoeba:
         print('Test: %s (epsilon=%g)' % (testName, options.epsilon))
@@ -46,99 +261,39 @@ def runOneTest(testName, options):
     else:
         print('Test: %s' % testName)
     print('Ensemble: %s' % options.ensemble)
-    platform = mm.Platform.getPlatformByName(options.platform)
     
     # Create the System.
 
+    system, positions, boxVectors = buildOrLoadSystem(testName, options)
     temperature = 300*unit.kelvin
     if explicit:
         friction = 1*(1/unit.picoseconds)
     else:
         friction = 91*(1/unit.picoseconds)
     if amoeba:
-        constraints = None
-        epsilon = float(options.epsilon)
-        if explicit:
-            ff = app.ForceField('amoeba2009.xml')
-            pdb = app.PDBFile('5dfr_solv-cube_equil.pdb')
-            cutoff = 0.7*unit.nanometers
-            vdwCutoff = 0.9*unit.nanometers
-            system = ff.createSystem(pdb.topology, nonbondedMethod=app.PME, nonbondedCutoff=cutoff, vdwCutoff=vdwCutoff, constraints=constraints, ewaldErrorTolerance=0.00075, mutualInducedTargetEpsilon=epsilon, polarization=options.polarization)
-        else:
-            ff = app.ForceField('amoeba2009.xml', 'amoeba2009_gk.xml')
-            pdb = app.PDBFile('5dfr_minimized.pdb')
-            system = ff.createSystem(pdb.topology, nonbondedMethod=app.NoCutoff, constraints=constraints, mutualInducedTargetEpsilon=epsilon, polarization=options.polarization)
-        for f in system.getForces():
-            if isinstance(f, mm.AmoebaMultipoleForce) or isinstance(f, mm.AmoebaVdwForce) or isinstance(f, mm.AmoebaGeneralizedKirkwoodForce) or isinstance(f, mm.AmoebaWcaDispersionForce):
-                f.setForceGroup(1)
         dt = 0.002*unit.picoseconds
         if options.ensemble == 'NVE':
             integ = mm.MTSIntegrator(dt, [(0,2), (1,1)])
         else:
             integ = mm.MTSLangevinIntegrator(temperature, friction, dt, [(0,2), (1,1)])
-        positions = pdb.positions
     elif amber:
-        dirname = downloadAmberSuite()
-        names = {'amber20-dhfr':'JAC',  'amber20-factorix':'FactorIX', 'amber20-cellulose':'Cellulose', 'amber20-stmv':'STMV'}
-        fileName = names[testName]
-        prmtop = app.AmberPrmtopFile(os.path.join(dirname, f'PME/Topologies/{fileName}.prmtop'))
-        inpcrd = app.AmberInpcrdFile(os.path.join(dirname, f'PME/Coordinates/{fileName}.inpcrd'))
-        positions = inpcrd.positions
         dt = 0.004*unit.picoseconds
-        method = app.PME
-        cutoff = options.cutoff
-        constraints = app.HBonds
-        hydrogenMass = 1.5*unit.amu
-        system = prmtop.createSystem(nonbondedMethod=method, nonbondedCutoff=cutoff, constraints=constraints)
         if options.ensemble == 'NVE':
             integ = mm.VerletIntegrator(dt)
         else:
             integ = mm.LangevinMiddleIntegrator(temperature, friction, dt)
-    else:
-        if apoa1:
-            ff = app.ForceField('amber14/protein.ff14SB.xml', 'amber14/lipid17.xml', 'amber14/tip3p.xml')
-            pdb = app.PDBFile('apoa1.pdb')
-            if testName == 'apoa1pme':
-                method = app.PME
-                cutoff = options.cutoff
-            elif testName == 'apoa1ljpme':
-                method = app.LJPME
-                cutoff = options.cutoff
-            else:
-                method = app.CutoffPeriodic
-                cutoff = 1*unit.nanometers
-        elif explicit:
-            ff = app.ForceField('amber99sb.xml', 'tip3p.xml')
-            pdb = app.PDBFile('5dfr_solv-cube_equil.pdb')
-            if testName == 'pme':
-                method = app.PME
-                cutoff = options.cutoff
-            else:
-                method = app.CutoffPeriodic
-                cutoff = 1*unit.nanometers
+    elif options.heavy:
+        dt = 0.005*unit.picoseconds
+        if options.ensemble == 'NVE':
+            integ = mm.VerletIntegrator(dt)
         else:
-            ff = app.ForceField('amber99sb.xml', 'amber99_obc.xml')
-            pdb = app.PDBFile('5dfr_minimized.pdb')
-            method = app.CutoffNonPeriodic
-            cutoff = 2*unit.nanometers
-        if options.heavy:
-            dt = 0.005*unit.picoseconds
-            constraints = app.AllBonds
-            hydrogenMass = 4*unit.amu
-            if options.ensemble == 'NVE':
-                integ = mm.VerletIntegrator(dt)
-            else:
-                integ = mm.LangevinIntegrator(temperature, friction, dt)
+            integ = mm.LangevinIntegrator(temperature, friction, dt)
+    else:
+        dt = 0.004*unit.picoseconds
+        if options.ensemble == 'NVE':
+            integ = mm.VerletIntegrator(dt)
         else:
-            dt = 0.004*unit.picoseconds
-            constraints = app.HBonds
-            hydrogenMass = 1.5*unit.amu
-            if options.ensemble == 'NVE':
-                integ = mm.VerletIntegrator(dt)
-            else:
-                integ = mm.LangevinMiddleIntegrator(temperature, friction, dt)
-        positions = pdb.positions
-        system = ff.createSystem(pdb.topology, nonbondedMethod=method, nonbondedCutoff=cutoff, constraints=constraints, hydrogenMass=hydrogenMass)
+            integ = mm.LangevinMiddleIntegrator(temperature, friction, dt)
     if options.ensemble == 'NPT':
         system.addForce(mm.MonteCarloBarostat(1*unit.bar, temperature, 100))
     print('Step Size: %g fs' % dt.value_in_unit(unit.femtoseconds))
@@ -150,6 +305,8 @@ def runOneTest(testName, options):
             initialSteps = 250
     if options.precision is not None and platform.getName() in ('CUDA', 'OpenCL'):
         properties['Precision'] = options.precision
+    if platform.getName() == 'CUDA':
+        properties['UseBlockingSync'] = ('true' if options.blockingSync else 'false')
 
     # Run the simulation.
     
@@ -158,57 +315,107 @@ def runOneTest(testName, options):
         context = mm.Context(system, integ, platform, properties)
     else:
         context = mm.Context(system, integ, platform)
+    positions = np.ascontiguousarray(positions.value_in_unit(unit.nanometers), dtype=np.float64) # Can be copied directly into the Context
     context.setPositions(positions)
     print('number of atoms', len(positions))
     if amber:
-        if inpcrd.boxVectors is not None:
-            context.setPeriodicBoxVectors(*inpcrd.boxVectors)
+        if boxVectors is not None:
+            context.setPeriodicBoxVectors(*boxVectors)
         mm.LocalEnergyMinimizer.minimize(context, 100*unit.kilojoules_per_mole/unit.nanometer)
     context.setVelocitiesToTemperature(temperature)
 
-    steps = 20
-    while True:
-        time = timeIntegration(context, steps, initialSteps)
-        if time >= 0.5*options.seconds:
-            break
-        if time < 0.5:
-            steps = int(steps*1.0/time) # Integrate enough steps to get a reasonable estimate for how many we'll need.
-        else:
-            steps = int(steps*options.seconds/time)
-    print('Integrated %d steps in %g seconds' % (steps, time))
-    print('%g ns/day' % (dt*steps*86400/time).value_in_unit(unit.nanoseconds))
-
-# Parse the command line options.
-
-parser = ArgumentParser()
-platformNames = [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())]
-parser.add_argument('--platform', dest='platform', choices=platformNames, help='name of the platform to benchmark')
-parser.add_argument('--test', dest='test', choices=('gbsa', 'rf', 'pme', 'apoa1rf', 'apoa1pme', 'apoa1ljpme', 'amoebagk', 'amoebapme', 'amber20-dhfr',  'amber20-factorix', 'amber20-cellulose', 'amber20-stmv'), 
-    help='the test to perform: gbsa, rf, pme, apoa1rf, apoa1pme, apoa1ljpme, amoebagk, amoebapme,  amber20-dhfr,  amber20-factorix, amber20-cellulose, amber20-stmv [default: all except amber-*]')
-parser.add_argument('--ensemble', default='NVT', dest='ensemble', choices=('NPT', 'NVE', 'NVT'), help='the thermodynamic ensemble to simulate [default: NVT]')
-parser.add_argument('--pme-cutoff', default=0.9, dest='cutoff', type=float, help='direct space cutoff for PME in nm [default: 0.9]')
-parser.add_argument('--seconds', default=60, dest='seconds', type=float, help='target simulation length in seconds [default: 60]')
-parser.add_argument('--polarization', default='mutual', dest='polarization', choices=('direct', 'extrapolated', 'mutual'), help='the polarization method for AMOEBA: direct, extrapolated, or mutual [default: mutual]')
-parser.add_argument('--mutual-epsilon', default=1e-5, dest='epsilon', type=float, help='mutual induced epsilon for AMOEBA [default: 1e-5]')
-parser.add_argument('--heavy-hydrogens', action='store_true', default=False, dest='heavy', help='repartition mass to allow a larger time step')
-parser.add_argument('--device', default=None, dest='device', help='device index for CUDA or OpenCL')
-parser.add_argument('--precision', default='single', dest='precision', choices=('single', 'mixed', 'double'), help='precision mode for CUDA or OpenCL: single, mixed, or double [default: single]')
-args = parser.parse_args()
-if args.platform is None:
-    parser.error('No platform specified')
-print('Platform:', args.platform)
-if args.platform in ('CUDA', 'OpenCL'):
-    print('Precision:', args.precision)
-    if args.device is not None:
-        print('Device:', args.device)
-
-# Run the simulations.
-
-if args.test is None:
-    for test in ('gbsa', 'rf', 'pme', 'apoa1rf', 'apoa1pme', 'apoa1ljpme', 'amoebagk', 'amoebapme'):
+    secondsPerStep = calibrate(context, initialSteps, min(2.0, 0.5*options.seconds))
+    steps = max(1, int(options.seconds/secondsPerStep))
+    seconds = timeIntegration(context, steps, 0)
+    print('Integrated %d steps in %g seconds' % (steps, seconds))
+    print('%g ns/day' % (dt*steps*86400/seconds).value_in_unit(unit.nanoseconds))
+
+def runTests(tests, options, platform):
+    """Run a series of tests one after another, reporting any that fail."""
+    for test in tests:
         try:
-            runOneTest(test, args)
+            runOneTest(test, options, platform)
         except Exception as ex:
-            print('Test failed: %s' % ex.message)
-else:
-    runOneTest(args.test, args)
+            print('Test failed: %s' % ex)
+
+def hideOtherDevices(platformName, device):
+    """Initialize a worker process that will only use a single device."""
+    if platformName == 'CUDA':
+        # Hide the other GPUs so creating the CUDA context doesn't need to initialize them.
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+
+def runTestOnDevice(test, options, device):
+    """Run a test in a worker process that only uses a single device, and return the output it produced.
+    The output is collected rather than printed so it doesn't get interleaved with output from other devices."""
+    options = copy.copy(options)
+    options.device = ('0' if options.platform == 'CUDA' else device)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        print()
+        print('Device:', device, end='')
+        runTests([test], options, mm.Platform.getPlatformByName(options.platform))
+    return output.getvalue()
+
+if __name__ == '__main__':
+
+    # Parse the command line options.
+
+    parser = ArgumentParser()
+    platformNames = [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())]
+    parser.add_argument('--platform', dest='platform', choices=platformNames, help='name of the platform to benchmark')
+    parser.add_argument('--test', dest='test', choices=tuple(TESTS), 
+        help='the test to perform: %s [default: all except amber-*]' % ', '.join(TESTS))
+    parser.add_argument('--ensemble', default='NVT', dest='ensemble', choices=('NPT', 'NVE', 'NVT'), help='the thermodynamic ensemble to simulate [default: NVT]')
+    parser.add_argument('--pme-cutoff', default=0.9, dest='cutoff', type=float, help='direct space cutoff for PME in nm [default: 0.9]')
+    parser.add_argument('--seconds', default=60, dest='seconds', type=float, help='target simulation length in seconds [default: 60]')
+    parser.add_argument('--polarization', default='mutual', dest='polarization', choices=('direct', 'extrapolated', 'mutual'), help='the polarization method for AMOEBA: direct, extrapolated, or mutual [default: mutual]')
+    parser.add_argument('--mutual-epsilon', default=1e-5, dest='epsilon', type=float, help='mutual induced epsilon for AMOEBA [default: 1e-5]')
+    parser.add_argument('--heavy-hydrogens', action='store_true', default=False, dest='heavy', help='repartition mass to allow a larger time step')
+    parser.add_argument('--device', default=None, dest='device', help='device index for CUDA or OpenCL')
+    parser.add_argument('--precision', default='single', dest='precision', choices=('single', 'mixed', 'double'), help='precision mode for CUDA or OpenCL: single, mixed, or double [default: single]')
+    parser.add_argument('--spin-wait', action='store_false', default=True, dest='blockingSync', help='for CUDA, busy-wait for the GPU instead of blocking, which can be slightly faster but uses a full CPU core')
+    parser.add_argument('--parallel-tests', action='store_true', default=False, dest='parallelTests', help='when multiple devices are specified, run different tests on each device at the same time instead of running each test on all of them')
+    parser.add_argument('--system-cache', default='system_cache', dest='systemCache', help='directory in which to cache the Systems, positions, and parsed input files for each test, or an empty string to disable caching.  Cached data is rebuilt whenever the OpenMM build or the input files change. [default: system_cache]')
+    parser.add_argument('--kernel-cache', default='kernel_cache', dest='kernelCache', help='directory in which the CUDA platform caches compiled kernels, so they survive cleanup of the temporary directory [default: kernel_cache]')
+    args = parser.parse_args()
+    if args.platform is None:
+        parser.error('No platform specified')
+    platform = mm.Platform.getPlatformByName(args.platform)
+    print('Platform:', args.platform)
+    if args.platform in ('CUDA', 'OpenCL'):
+        print('Precision:', args.precision)
+        if args.device is not None:
+            print('Device:', args.device)
+
+    # The CUDA platform caches compiled kernels in OPENMM_CACHE_DIR, which defaults to the temporary directory.
+    # Point it at a persistent directory so the cache survives the temporary directory being cleaned up.
+
+    if args.platform == 'CUDA' and 'OPENMM_CACHE_DIR' not in os.environ:
+        os.makedirs(args.kernelCache, exist_ok=True)
+        os.environ['OPENMM_CACHE_DIR'] = os.path.abspath(args.kernelCache)
+
+    # Run the simulations.
+
+    tests = tuple(test for test in TESTS if 'amber' not in TESTS[test]) if args.test is None else (args.test,)
+    devices = [] if args.device is None else args.device.replace(',', ' ').split()
+    if args.parallelTests and len(devices) > 1 and len(tests) > 1:
+        # Use a separate worker process for each device, since CUDA_VISIBLE_DEVICES only takes effect
+        # in a process that has not yet initialized CUDA.
+
+        sys.stdout.flush() # Otherwise forked workers may write out our buffered output a second time
+        executors = [ProcessPoolExecutor(max_workers=1, initializer=hideOtherDevices, initargs=(args.platform, device)) for device in devices]
+        testDevices = [i%len(devices) for i in range(len(tests))]
+        futures = [executors[d].submit(runTestOnDevice, test, args, devices[d]) for test, d in zip(tests, testDevices)]
+        for test, d, future in zip(tests, testDevices, futures):
+            try:
+                print(future.result(), end='')
+            except Exception as ex:
+                print()
+                print('Test %s on device %s failed: %s' % (test, devices[d], ex))
+            sys.stdout.flush()
+        for executor in executors:
+            executor.shutdown()
+    elif args.test is None:
+        runTests(tests, args, platform)
+    else:
+        runOneTest(args.test, args, platform)